@@ -0,0 +1,231 @@
+"""
+Shared pagination for the The Graph fetchers (fetch_uniswap_v2.py, fetch_uniswap_v3.py, fetch_cowswap.py).
+Each fetcher supplies its endpoint, Parquet schema, aliased query field and page flattener;
+this module pages the subgraph concurrently and streams the filtered rows into Parquet.
+"""
+
+import asyncio
+import functools
+import os
+import time
+
+import httpx
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Time windows are paged concurrently on one event loop; the rate limit below is shared by all of them.
+MAX_CONCURRENT_REQUESTS = 8
+WINDOW_SECONDS = 60 * 60  # hourly, so even a one-day run is split into 24 concurrent tasks
+MIN_REQUEST_INTERVAL = 0.1  # seconds between requests, across all windows
+ROW_GROUP_SIZE = 64 * 1024  # filtered rows buffered before each Parquet row group is written
+MAX_RETRIES = 3  # attempts per query before a GraphQL error aborts the fetch
+
+
+def rate_limited(min_interval):
+    """
+    Decorator for coroutines that spaces calls at least `min_interval` seconds apart.
+    All callers share one event loop, so reserving the next slot needs no lock.
+    """
+    next_allowed = [0.0]
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            now = time.monotonic()
+            wait = next_allowed[0] - now
+            next_allowed[0] = max(now, next_allowed[0]) + min_interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@rate_limited(MIN_REQUEST_INTERVAL)
+async def post(client, url, payload):
+    return await client.post(url, json=payload)
+
+
+def split_windows(start_timestamp, end_timestamp, step=WINDOW_SECONDS):
+    """
+    Split [start_timestamp, end_timestamp) into disjoint [lo, hi) windows of at most `step` seconds.
+    """
+    return [(lo, min(lo + step, end_timestamp)) for lo in range(int(start_timestamp), int(end_timestamp), step)]
+
+
+def id_buckets():
+    """
+    Split the '0x'-prefixed hex id space into 16 [lo, hi) ranges by leading hex digit.
+    """
+    digits = "0123456789abcdef"
+    # 'g' sorts after every hex digit, so it closes the last bucket.
+    return [("0x" + d, "0x" + (digits[k + 1] if k + 1 < len(digits) else "g")) for k, d in enumerate(digits)]
+
+
+@functools.lru_cache(maxsize=None)
+def build_query(bucket_field, n_buckets, batch_size):
+    """
+    Build one GraphQL query that pages `n_buckets` id ranges at once via aliases b0, b1, ...
+    `bucket_field` is a %-template for one alias; alias k reads its cursor/upper bound from
+    the variables $last<k> / $hi<k>. Cached, so each query string is built once.
+    """
+    params = ", ".join("$last%d: String!, $hi%d: String!" % (k, k) for k in range(n_buckets))
+    fields = "".join(bucket_field % {"k": k, "batch_size": batch_size} for k in range(n_buckets))
+    return """
+        query($startTime: Int!, $endTime: Int!, %s) {%s
+        }
+        """ % (params, fields)
+
+
+def raw_schema(schema):
+    """
+    Same layout as `schema` with the float64 amount columns still as the subgraph's decimal strings.
+    Pages are built against this and cast to `schema`, so the amounts are parsed to float64 once
+    at fetch time rather than on every analysis run.
+    """
+    return pa.schema([f.with_type(pa.string()) if f.type == pa.float64() else f for f in schema])
+
+
+def filter_token_pair(table, col_a, col_b, token_pair):
+    """
+    Keep only the rows whose two token symbol columns are exactly the two tokens of `token_pair`.
+    """
+    pair = pa.array(token_pair)
+    a, b = table.column(col_a), table.column(col_b)
+    mask = pc.and_(pc.and_(pc.is_in(a, value_set=pair), pc.is_in(b, value_set=pair)), pc.not_equal(a, b))
+    return table.filter(mask)
+
+
+class PageWriter:
+    """
+    Sink that buffers filtered pages and writes them to Parquet one row group at a time,
+    so memory stays bounded by ROW_GROUP_SIZE instead of the whole month.
+    """
+
+    def __init__(self, path, schema):
+        self._writer = pq.ParquetWriter(path, schema, compression="zstd")
+        self._pending = []
+        self._pending_rows = 0
+        self.num_rows = 0
+
+    def write(self, table):
+        if table.num_rows == 0:
+            return
+        self._pending.append(table)
+        self._pending_rows += table.num_rows
+        self.num_rows += table.num_rows
+        if self._pending_rows >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._writer.write_table(pa.concat_tables(self._pending))
+            self._pending = []
+            self._pending_rows = 0
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+async def fetch_window(client, semaphore, url, bucket_field, start_timestamp, end_timestamp, on_page, batch_size=1000):
+    """
+    Page through all entities in [start_timestamp, end_timestamp), handing each page to `on_page`.
+    Returns the number of entities fetched (before filtering).
+    """
+    # The Graph endpoint might limit how many results per query (1000 for example).
+    # We'll use a 'last_id' approach for pagination, with the id space pre-split into
+    # hex-prefix buckets so one POST advances every bucket's cursor at once.
+
+    n_fetched = 0
+    buckets = id_buckets()
+    cursors = {i: lo for i, (lo, _) in enumerate(buckets)}
+
+    while cursors:
+        # Exhausted buckets drop out, so the batch shrinks down to single queries.
+        active = sorted(cursors)
+        query = build_query(bucket_field, len(active), batch_size)
+
+        variables = {
+            "startTime": int(start_timestamp),
+            "endTime": int(end_timestamp),
+        }
+        for k, i in enumerate(active):
+            variables[f"last{k}"] = cursors[i]
+            variables[f"hi{k}"] = buckets[i][1]
+        for attempt in range(1, MAX_RETRIES + 1):
+            # Timeouts, dropped connections and non-JSON gateway replies (e.g. a 502 HTML page)
+            # are retried like GraphQL errors rather than aborting every window in the gather.
+            try:
+                async with semaphore:
+                    response = await post(client, url, {"query": query, "variables": variables})
+                response.raise_for_status()
+                response_json = response.json()
+            except (httpx.HTTPError, ValueError) as exc:
+                error = repr(exc)
+            else:
+                data = response_json.get("data") or {}
+
+                # GraphQL may answer some aliases and report the rest under "errors" with a null
+                # value; a failed alias must not be mistaken for an exhausted bucket.
+                if not response_json.get("errors") and all(data.get(f"b{k}") is not None for k in range(len(active))):
+                    break
+                error = response_json.get("errors") or response_json
+            print(f"Error in response (attempt {attempt}/{MAX_RETRIES}):", error)
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+        else:
+            raise RuntimeError(
+                f"Subgraph query for [{start_timestamp}, {end_timestamp}) failed after {MAX_RETRIES} attempts: {error}"
+            )
+
+        for k, i in enumerate(active):
+            page = data[f"b{k}"]
+            on_page(page)
+            n_fetched += len(page)
+            if len(page) < batch_size:
+                # No more data in this bucket
+                del cursors[i]
+            else:
+                cursors[i] = page[-1]["id"]  # update pagination key
+
+    return n_fetched
+
+
+async def fetch_to_parquet(url, bucket_field, schema, to_table, start_timestamp, end_timestamp, out_parquet,
+                           batch_size=1000, token_pair=("WETH", "USDT")):
+    """
+    Page every entity in [start_timestamp, end_timestamp) from the subgraph at `url`, flatten and filter
+    each page with `to_table(page, token_pair)`, and stream the result into `out_parquet`.
+    Returns the number of rows written.
+    """
+    # Written next to the target and renamed only on success, so a failed or interrupted
+    # fetch never leaves a truncated Parquet file behind for analyze.py to pick up.
+    tmp_parquet = out_parquet + ".tmp"
+    writer = PageWriter(tmp_parquet, schema)
+
+    def write_page(page):
+        writer.write(to_table(page, token_pair))
+
+    # Each hourly window is paged independently, so the windows run concurrently under
+    # asyncio.gather, with at most MAX_CONCURRENT_REQUESTS requests in flight.
+    windows = split_windows(start_timestamp, end_timestamp)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    try:
+        async with httpx.AsyncClient(http2=True, timeout=30) as client:
+            counts = await asyncio.gather(*(
+                fetch_window(client, semaphore, url, bucket_field, lo, hi, write_page, batch_size)
+                for lo, hi in windows
+            ))
+        writer.close()
+    except BaseException:
+        try:
+            writer.close()
+        finally:
+            os.remove(tmp_parquet)
+        raise
+    os.replace(tmp_parquet, out_parquet)
+    print(f"Fetched {sum(counts)} records across {len(windows)} windows")
+
+    return writer.num_rows
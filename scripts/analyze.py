@@ -1,28 +1,43 @@
 #!/usr/bin/env python3
 """
 Analyze the DEX trades vs. Binance mid-price, compute average cost difference by trade size.
-Outputs intermediate aggregated CSV files for each DEX.
+Outputs intermediate aggregated Parquet files for each DEX (read by plot_results.py).
 """
 
 import pandas as pd
 import numpy as np
 import os
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; merge_with_midprice falls back to pd.merge_asof
+    njit = None
+
+MIDPRICES_CACHE = "data/binance_midprices_1min.parquet"
+MIDPRICES_CACHE_VERSION = "2"  # bump whenever compute_mid_prices changes, to invalidate old caches
+MIDPRICE_TOLERANCE = pd.Timedelta("1min")
+
 def load_binance_trades(parquet_or_csv):
     """
     Load Binance data from a Parquet or CSV file.
-    Expects columns: ['timestamp','datetime','mid_price','volume'] (based on your check.py output).
+    The file has columns ['timestamp','datetime','mid_price','volume'] (based on your check.py output);
+    only 'datetime' and 'mid_price' are used downstream, so only those are read.
     """
+    columns = ["datetime", "mid_price"]
     if parquet_or_csv.endswith(".parquet"):
-        df = pd.read_parquet(parquet_or_csv)
+        df = pd.read_parquet(parquet_or_csv, columns=columns, engine="pyarrow")
     else:
-        df = pd.read_csv(parquet_or_csv)
+        df = pd.read_csv(parquet_or_csv, usecols=columns)
     
     # If you prefer to rely on 'timestamp', do:
     # df["timestamp"] = pd.to_datetime(df["timestamp"], unit='ms')
-    # Otherwise, your file already has 'datetime' as a string—convert to a real datetime dtype.
-    df["datetime"] = pd.to_datetime(df["datetime"])
+    # Parquet usually stores 'datetime' as datetime64[ns] already; CSV gives strings to convert.
+    # merge_asof needs the same datetime64[ns] dtype as the DEX 'timestamp_dt'.
+    if df["datetime"].dtype != "datetime64[ns]":
+        df["datetime"] = pd.to_datetime(df["datetime"]).astype("datetime64[ns]")
     
     return df
 
@@ -30,127 +45,275 @@ def compute_mid_prices(binance_df, freq="1min"):
     """
     Approximate mid-price by averaging 'mid_price' in each time bucket (1min).
     The file has columns ['datetime','mid_price'], so we use 'datetime' as our time index.
+    Buckets come from flooring the int64 nanosecond timestamps, so the trades need no
+    sort/copy/set_index before grouping (same buckets as resample(freq)).
     """
-    binance_df = binance_df.sort_values("datetime").copy()
-    binance_df.set_index("datetime", inplace=True)
+    # NaT views as int64 min and would floor to a bucket in 2262; resample() dropped it
+    times = binance_df["datetime"].to_numpy(dtype="datetime64[ns]")
+    valid = ~np.isnat(times)
+    ns = times[valid].view("int64")
+    step = pd.Timedelta(freq).value
+    bucket = (ns - ns % step).view("datetime64[ns]")
+
+    prices = binance_df["mid_price"].to_numpy()[valid]
+    means = pd.Series(prices).groupby(bucket).mean()
 
-    # Resample on 1-min intervals
-    df_resampled = binance_df["mid_price"].resample(freq).mean().ffill()
+    # Fill minutes without trades from the previous minute, as resample().mean().ffill() did
+    full_index = pd.date_range(means.index.min(), means.index.max(), freq=freq)
+    df_resampled = means.reindex(full_index).ffill()
 
     # Convert to DataFrame named 'mid_price'
-    df_resampled = df_resampled.to_frame(name="mid_price").reset_index()
+    df_resampled = df_resampled.rename_axis("datetime").to_frame(name="mid_price").reset_index()
     # So now we have columns: ['datetime','mid_price']
     return df_resampled
 
+def epoch_seconds_to_datetime(seconds):
+    """
+    Convert an integer epoch-seconds column to datetime64[ns] by scaling and reinterpreting the int64
+    buffer, which is the exact dtype merge_asof compares against the Binance 'datetime' column.
+    """
+    ns = seconds.to_numpy(dtype="int64") * np.int64(1_000_000_000)
+    return ns.view("datetime64[ns]")
+
+def load_or_compute_mid_prices(binance_file, cache_file=MIDPRICES_CACHE, freq="1min"):
+    """
+    Return the `freq` mid-prices sorted by 'datetime'.
+    They are cached in `cache_file`, whose Parquet metadata records the source file, `freq` and
+    MIDPRICES_CACHE_VERSION. The cache is reused only if all three match and `binance_file` is not
+    newer (or no longer exists), so repeated runs skip loading and resampling the full Binance trade stream.
+    """
+    cache_key = {
+        b"source": os.path.normpath(binance_file).encode(),
+        b"freq": freq.encode(),
+        b"version": MIDPRICES_CACHE_VERSION.encode(),
+    }
+    if os.path.exists(cache_file):
+        metadata = pq.read_schema(cache_file).metadata or {}
+        matches = all(metadata.get(k) == v for k, v in cache_key.items())
+        if matches and (not os.path.exists(binance_file)
+                        or os.path.getmtime(cache_file) >= os.path.getmtime(binance_file)):
+            return pd.read_parquet(cache_file)
+
+    binance_trades = load_binance_trades(binance_file)
+    midprices = compute_mid_prices(binance_trades, freq).sort_values("datetime", ignore_index=True)
+    table = pa.Table.from_pandas(midprices, preserve_index=False)
+    pq.write_table(table.replace_schema_metadata({**table.schema.metadata, **cache_key}), cache_file)
+    return midprices
+
 def compute_realized_prices_uniswap_v2(df):
     """
     For Uniswap v2, we have columns: [amount0In, amount0Out, amount1In, amount1Out, timestamp].
     We treat 'amount0Out' as WETH sold, 'amount1In' as USDT received.
     Realized price = USDT received / WETH sold.
+    Trade size in USD = the USDT leg of the swap (amount1In or amount1Out).
+    The amount columns are already float64 (parsed once by fetch_uniswap_v2.py).
     """
-    numeric_cols = ["amount0In", "amount0Out", "amount1In", "amount1Out"]
-    for col in numeric_cols:
-        df[col] = df[col].astype(float)
-    
-    df["realized_price"] = np.where(
-        df["amount0Out"] > 0,
-        df["amount1In"] / df["amount0Out"],   # WETH -> USDT
-        df["amount0In"] / df["amount1Out"]    # USDT -> WETH
-    )
+    amount0_in = df["amount0In"].to_numpy(dtype=np.float64)
+    amount0_out = df["amount0Out"].to_numpy(dtype=np.float64)
+    amount1_in = df["amount1In"].to_numpy(dtype=np.float64)
+    amount1_out = df["amount1Out"].to_numpy(dtype=np.float64)
+
+    # Divide each row only on the branch that applies, instead of evaluating both like np.where.
+    mask = amount0_out > 0
+    realized_price = np.empty(len(df))
+    np.divide(amount1_in, amount0_out, out=realized_price, where=mask)    # WETH -> USDT
+    np.divide(amount0_in, amount1_out, out=realized_price, where=~mask)   # USDT -> WETH
+    df["realized_price"] = realized_price
+    # Same mask picks the USDT leg, so main_analysis doesn't recompare amount0Out
+    df["trade_size_usd"] = np.where(mask, amount1_in, amount1_out)
     # Convert timestamp to datetime
-    df["timestamp_dt"] = pd.to_datetime(df["timestamp"], unit='s')
+    df["timestamp_dt"] = epoch_seconds_to_datetime(df["timestamp"])
     return df
 
 def compute_realized_prices_uniswap_v3(df):
     """
     For Uniswap v3, we have columns: [amount0, amount1, timestamp].
     We do a naive approach for realized price = amount1/amount0, etc.
+    Trade size in USD = |amount1| (naive approach).
     """
-    df["amount0"] = df["amount0"].astype(float)
-    df["amount1"] = df["amount1"].astype(float)
-    
-    df["realized_price"] = np.where(
-        df["amount0"] > 0,
-        df["amount1"] / df["amount0"],
-        df["amount0"] / df["amount1"]
-    )
-    df["timestamp_dt"] = pd.to_datetime(df["timestamp"], unit='s')
+    amount0 = df["amount0"].to_numpy(dtype=np.float64)
+    amount1 = df["amount1"].to_numpy(dtype=np.float64)
+
+    # As in v2, only divide on the branch that applies, so amount1 == 0 rows on the
+    # amount0 > 0 side no longer hit a divide-by-zero in the unused branch.
+    mask = amount0 > 0
+    realized_price = np.empty_like(amount0)
+    np.divide(amount1, amount0, out=realized_price, where=mask)
+    np.divide(amount0, amount1, out=realized_price, where=~mask)
+    df["realized_price"] = realized_price
+    df["trade_size_usd"] = np.abs(amount1)
+    df["timestamp_dt"] = epoch_seconds_to_datetime(df["timestamp"])
     return df
 
 def compute_realized_prices_cowswap(df):
     """
     For Cowswap, columns: [sellAmount, buyAmount, creationTimestamp].
-    Realized price = buyAmount / sellAmount.
+    Realized price = buyAmount / sellAmount; trade size in USD = buyAmount.
     """
-    df["sellAmount"] = df["sellAmount"].astype(float)
-    df["buyAmount"]  = df["buyAmount"].astype(float)
     df["realized_price"] = df["buyAmount"] / df["sellAmount"]
+    df["trade_size_usd"] = df["buyAmount"]
     
-    df["timestamp_dt"] = pd.to_datetime(df["creationTimestamp"], unit='s')
+    df["timestamp_dt"] = epoch_seconds_to_datetime(df["creationTimestamp"])
     return df
 
-def merge_with_midprice(df, midprices_df):
+def project_for_merge(df):
+    """
+    Keep only the columns used after the merge, so merge_asof doesn't copy the raw amounts
+    and token columns for every row. Price and size are float32: the bucket means don't need
+    double precision, and it halves the memory traffic through the join.
+    """
+    return df[["timestamp_dt", "realized_price", "trade_size_usd"]].astype(
+        {"realized_price": "float32", "trade_size_usd": "float32"}
+    )
+
+def _asof_nearest_diff(left_ts, right_ts, right_mid, realized_price, tolerance, out_diff):
     """
-    Merge DEX trades with the nearest Binance mid-price via pandas.merge_asof.
-    DEX data has 'timestamp_dt'; midprices_df has 'datetime' from compute_mid_prices().
+    Single-pass nearest asof join over two ascending int64 timestamp arrays.
+    Writes realized_price[i] - (mid-price nearest to left_ts[i]) into out_diff[i], or NaN when
+    no mid-price lies within `tolerance`. Ties go to the earlier mid-price, as in merge_asof.
     """
-    df_sorted = df.sort_values("timestamp_dt").reset_index(drop=True)
+    n_right = len(right_ts)
+    j = -1  # last right index with right_ts[j] <= left_ts[i]
+    for i in range(len(left_ts)):
+        t = left_ts[i]
+        while j + 1 < n_right and right_ts[j + 1] <= t:
+            j += 1
+        best = -1
+        if j >= 0 and t - right_ts[j] <= tolerance:
+            best = j
+        if j + 1 < n_right and right_ts[j + 1] - t <= tolerance:
+            if best == -1 or right_ts[j + 1] - t < t - right_ts[best]:
+                best = j + 1
+        if best >= 0:
+            out_diff[i] = realized_price[i] - right_mid[best]
+        else:
+            out_diff[i] = np.nan
 
-    # rename 'datetime' to a uniform name, or directly use 'datetime' below
-    mid_sorted = midprices_df.sort_values("datetime").reset_index(drop=True)
+if njit is not None:
+    _asof_nearest_diff = njit(cache=True)(_asof_nearest_diff)
+
+def merge_with_midprice(df, mid_sorted):
+    """
+    Attach 'price_diff' = realized price minus the nearest Binance mid-price to each DEX trade.
+    DEX data has 'timestamp_dt'; mid_sorted has 'datetime' from load_or_compute_mid_prices(),
+    already in ascending order, so it is not re-sorted for every DEX.
+    Trades with no mid-price within 1 minute get NaN and drop out of the bucket means.
+    With numba available this runs the jitted _asof_nearest_diff kernel and never builds the
+    merged frame; otherwise (or for unexpected dtypes) it uses pandas.merge_asof.
+    """
+    # Subgraph rows come back ordered by id, so the DEX side still needs a sort.
+    df_sorted = df.sort_values("timestamp_dt", kind="stable", ignore_index=True)
+
+    assert mid_sorted["datetime"].is_monotonic_increasing, "mid_sorted must be sorted by 'datetime'"
+
+    if (njit is not None
+            and df_sorted["timestamp_dt"].dtype == "datetime64[ns]"
+            and mid_sorted["datetime"].dtype == "datetime64[ns]"):
+        price_diff = np.empty(len(df_sorted))
+        _asof_nearest_diff(
+            df_sorted["timestamp_dt"].to_numpy().view("int64"),
+            mid_sorted["datetime"].to_numpy().view("int64"),
+            mid_sorted["mid_price"].to_numpy(dtype=np.float64),
+            df_sorted["realized_price"].to_numpy(),
+            MIDPRICE_TOLERANCE.value,
+            price_diff,
+        )
+        df_sorted["price_diff"] = price_diff
+        return df_sorted
 
     merged = pd.merge_asof(
         df_sorted,
         mid_sorted,
         left_on="timestamp_dt",
         right_on="datetime",
-        direction="nearest"
+        direction="nearest",
+        tolerance=MIDPRICE_TOLERANCE
     )
     merged["price_diff"] = merged["realized_price"] - merged["mid_price"]
     return merged
 
+def format_bucket_labels(edges):
+    """
+    Label the right-closed buckets between consecutive `edges` as '(lo, hi]' for plotting.
+    Edges are rounded to whole USD where that keeps them distinct, otherwise to the fewest
+    decimals that do, so sub-dollar buckets never collapse onto the same category label.
+    """
+    for precision in range(16):
+        rounded = [np.format_float_positional(e, precision=precision, unique=False, trim="-") for e in edges]
+        if len(set(rounded)) == len(rounded):
+            break
+    else:
+        rounded = [np.format_float_positional(e) for e in edges]
+    return [f"({lo}, {hi}]" for lo, hi in zip(rounded[:-1], rounded[1:])]
+
 def bucket_by_trade_size(df, size_col, n_buckets=10):
     """
     Group trades by trade size in USD (e.g., 'amount1In' or 'buyAmount' as USDT).
+    Same buckets as pd.qcut(..., duplicates='drop'): quantile edges, right-closed intervals,
+    with the lowest bucket also taking the minimum. Computed with np.digitize + np.bincount,
+    so no Categorical/IntervalIndex or groupby is built; 'bucket' holds the edge pair as a string
+    and 'bucket_str' the short unique label from format_bucket_labels, ready to use on the plot.
     """
-    df["bucket"] = pd.qcut(df[size_col], q=n_buckets, duplicates='drop')
-    grouped = df.groupby("bucket")["price_diff"].mean().reset_index()
-    grouped.rename(columns={"price_diff": "avg_cost_diff"}, inplace=True)
+    sizes = df[size_col].to_numpy(dtype=np.float64)
+    diffs = df["price_diff"].to_numpy(dtype=np.float64)
+    sizes, diffs = sizes[~np.isnan(sizes)], diffs[~np.isnan(sizes)]
+
+    edges = np.unique(np.quantile(sizes, np.linspace(0, 1, n_buckets + 1)))
+    n_bins = len(edges) - 1
+    idx = np.digitize(sizes, edges[1:-1], right=True)
+
+    # Like groupby().mean(), skip trades without a matched mid-price.
+    has_diff = ~np.isnan(diffs)
+    sums = np.bincount(idx[has_diff], weights=diffs[has_diff], minlength=n_bins)
+    counts = np.bincount(idx[has_diff], minlength=n_bins)
+    means = np.full(n_bins, np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+
+    edge_pairs = list(zip(edges[:-1], edges[1:]))
+    grouped = pd.DataFrame({
+        "bucket": [f"({lo:.3f}, {hi:.3f}]" for lo, hi in edge_pairs],
+        "bucket_str": format_bucket_labels(edges),
+        "avg_cost_diff": means,
+    })
     return grouped
 
 def main_analysis():
     # 1) Load Binance data
     binance_file = "data/cex_trades_binance_ETH_USDT-2024-01.parquet"
-    binance_trades = load_binance_trades(binance_file)
-    midprices = compute_mid_prices(binance_trades)  # columns: ['datetime','mid_price']
+    # columns: ['datetime','mid_price'], sorted once here and reused for every DEX merge
+    midprices = load_or_compute_mid_prices(binance_file)
 
     # 2) Uniswap v2
-    df_v2 = pd.read_csv("data/uniswap_v2_jan2024.csv")
+    df_v2 = pd.read_parquet(
+        "data/uniswap_v2_jan2024.parquet",
+        columns=["timestamp", "amount0In", "amount0Out", "amount1In", "amount1Out"]
+    )
     df_v2 = compute_realized_prices_uniswap_v2(df_v2)
-    df_v2["trade_size_usd"] = np.where(
-        df_v2["amount0Out"] > 0, df_v2["amount1In"], df_v2["amount1Out"]
-    ).astype(float)
+    df_v2 = project_for_merge(df_v2)
     merged_v2 = merge_with_midprice(df_v2, midprices)
     v2_buckets = bucket_by_trade_size(merged_v2, "trade_size_usd", 10)
-    v2_buckets.to_csv("data/uniswap_v2_aggregated.csv", index=False)
+    v2_buckets.to_parquet("data/uniswap_v2_aggregated.parquet", index=False)
 
     # 3) Uniswap v3
-    df_v3 = pd.read_csv("data/uniswap_v3_jan2024.csv")
+    df_v3 = pd.read_parquet(
+        "data/uniswap_v3_jan2024.parquet",
+        columns=["timestamp", "amount0", "amount1"]
+    )
     df_v3 = compute_realized_prices_uniswap_v3(df_v3)
-    df_v3["trade_size_usd"] = df_v3["amount1"].abs()  # naive approach
+    df_v3 = project_for_merge(df_v3)
     merged_v3 = merge_with_midprice(df_v3, midprices)
     v3_buckets = bucket_by_trade_size(merged_v3, "trade_size_usd", 10)
-    v3_buckets.to_csv("data/uniswap_v3_aggregated.csv", index=False)
+    v3_buckets.to_parquet("data/uniswap_v3_aggregated.parquet", index=False)
 
     # 4) Cowswap (optional; if you have no data, comment out)
-    # df_cw = pd.read_csv("data/cowswap_jan2024.csv")
+    # df_cw = pd.read_parquet("data/cowswap_jan2024.parquet", columns=["creationTimestamp", "sellAmount", "buyAmount"])
     # df_cw = compute_realized_prices_cowswap(df_cw)
-    # df_cw["trade_size_usd"] = df_cw["buyAmount"]
+    # df_cw = project_for_merge(df_cw)
     # merged_cw = merge_with_midprice(df_cw, midprices)
     # cw_buckets = bucket_by_trade_size(merged_cw, "trade_size_usd", 10)
-    # cw_buckets.to_csv("data/cowswap_aggregated.csv", index=False)
+    # cw_buckets.to_parquet("data/cowswap_aggregated.parquet", index=False)
 
-    print("Analysis done. Aggregated CSVs saved in data/ folder.")
+    print("Analysis done. Aggregated Parquet files saved in data/ folder.")
 
 if __name__ == "__main__":
     main_analysis()
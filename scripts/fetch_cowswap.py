@@ -3,38 +3,41 @@
 Fetch Cowswap WETH/USDT trades for Jan 2024. 
 Cowswap also has a The Graph subgraph, but the endpoint can differ.
 Below is an example approach.
-Outputs CSV: data/cowswap_jan2024.csv
+Outputs Parquet: data/cowswap_jan2024.parquet
 """
 
-import requests
-import pandas as pd
-import time
+import asyncio
 import os
 from datetime import datetime
 
+import pyarrow as pa
+
+from _subgraph import fetch_to_parquet, filter_token_pair, raw_schema
+
 # Note: The following subgraph is an example from CoW Protocol docs:
 COWSWAP_SUBGRAPH = "https://gateway.thegraph.com/api/df43a2bc1070b588a29f977563828492/subgraphs/id/H2gFH3qBTB1GPzy1xTbf85P9JMhq6sHGMmu1JKUmA6bg"
 
-def fetch_cowswap_trades(start_timestamp, end_timestamp, batch_size=1000, token_pair=("WETH", "USDT")):
-    """
-    Fetch CowSwap (CoW Protocol) trades for WETH/USDT in [start_timestamp, end_timestamp).
-    Returns a Pandas DataFrame.
-    """
-    all_orders = []
-    last_id = ""
-    
-    while True:
-        query = """
-        query($startTime: Int!, $endTime: Int!, $lastID: String!) {
-          orders(
+ORDER_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("creationTimestamp", pa.int64()),
+    ("sellToken", pa.string()),
+    ("buyToken", pa.string()),
+    ("sellAmount", pa.float64()),
+    ("buyAmount", pa.float64()),
+])
+_RAW_ORDER_SCHEMA = raw_schema(ORDER_SCHEMA)
+
+_BUCKET_FIELD = """
+          b%(k)d: orders(
             where: {
               creationTimestamp_gte: $startTime,
               creationTimestamp_lt:  $endTime,
-              id_gt: $lastID
+              id_gt: $last%(k)d,
+              id_lt: $hi%(k)d
             }
             orderBy: id
             orderDirection: asc
-            first: %d
+            first: %(batch_size)d
           ) {
             id
             creationTimestamp
@@ -42,44 +45,34 @@ def fetch_cowswap_trades(start_timestamp, end_timestamp, batch_size=1000, token_
             buyToken { symbol }
             sellAmount
             buyAmount
-          }
-        }
-        """ % batch_size
-        
-        variables = {
-            "startTime": int(start_timestamp),
-            "endTime": int(end_timestamp),
-            "lastID": last_id
-        }
-        
-        response = requests.post(COWSWAP_SUBGRAPH, json={"query": query, "variables": variables})
-        response_json = response.json()
-        
-        if "data" not in response_json or "orders" not in response_json["data"]:
-            print("Error in response:", response_json)
-            break
-        
-        orders = response_json["data"]["orders"]
-        if not orders:
-            break
-        
-        all_orders.extend(orders)
-        
-        last_id = orders[-1]["id"]
-        time.sleep(0.2)
-    
-    df = pd.DataFrame(all_orders)
-    df["creationTimestamp"] = df["creationTimestamp"].astype(int)
-    
-    # Filter only WETH/USDT
-    def is_weth_usdt(sell_token, buy_token):
-        tokens = {sell_token, buy_token}
-        return tokens == set(token_pair)
-    
-    mask = df.apply(lambda row: is_weth_usdt(row["sellToken"]["symbol"], row["buyToken"]["symbol"]), axis=1)
-    df = df[mask]
-    
-    return df
+          }"""
+
+
+def _to_table(orders, token_pair):
+    """
+    Flatten one page of CowSwap orders into an Arrow table and keep only the rows trading `token_pair`.
+    """
+    cols = {
+        "id": [o["id"] for o in orders],
+        "creationTimestamp": pa.array([int(o["creationTimestamp"]) for o in orders], type=pa.int64()),
+        "sellToken": [o["sellToken"]["symbol"] for o in orders],
+        "buyToken": [o["buyToken"]["symbol"] for o in orders],
+        "sellAmount": [o["sellAmount"] for o in orders],
+        "buyAmount": [o["buyAmount"] for o in orders],
+    }
+    table = pa.Table.from_pydict(cols, schema=_RAW_ORDER_SCHEMA).cast(ORDER_SCHEMA)
+    return filter_token_pair(table, "sellToken", "buyToken", token_pair)
+
+
+async def fetch_cowswap_trades(start_timestamp, end_timestamp, out_parquet, batch_size=1000, token_pair=("WETH", "USDT")):
+    """
+    Fetch CowSwap (CoW Protocol) trades for WETH/USDT in [start_timestamp, end_timestamp).
+    Streams each filtered page into `out_parquet` and returns the number of orders written.
+    """
+    return await fetch_to_parquet(
+        COWSWAP_SUBGRAPH, _BUCKET_FIELD, ORDER_SCHEMA, _to_table,
+        start_timestamp, end_timestamp, out_parquet, batch_size, token_pair
+    )
 
 
 if __name__ == "__main__":
@@ -90,11 +83,9 @@ if __name__ == "__main__":
     start_timestamp = int(start_dt.timestamp())
     end_timestamp   = int(end_dt.timestamp())
     
-    df_cw = fetch_cowswap_trades(start_timestamp, end_timestamp)
-    print(f"Fetched {len(df_cw)} Cowswap orders")
-    
     os.makedirs("data", exist_ok=True)
     
-    out_csv = "data/cowswap_jan2024.csv"
-    df_cw.to_csv(out_csv, index=False)
-    print(f"Saved to {out_csv}")
+    out_parquet = "data/cowswap_jan2024.parquet"
+    n_cw = asyncio.run(fetch_cowswap_trades(start_timestamp, end_timestamp, out_parquet))
+    print(f"Fetched {n_cw} Cowswap orders")
+    print(f"Saved to {out_parquet}")
@@ -1,43 +1,42 @@
 #!/usr/bin/env python3
 """
 Fetch Uniswap v2 WETH/USDT trades for Jan 2024 from The Graph subgraph.
-Outputs CSV: data/uniswap_v2_jan2024.csv
+Outputs Parquet: data/uniswap_v2_jan2024.parquet
 """
 
-import requests
-import pandas as pd
-import time
+import asyncio
 import os
 from datetime import datetime
 
+import pyarrow as pa
+
+from _subgraph import fetch_to_parquet, filter_token_pair, raw_schema
+
 UNISWAP_V2_SUBGRAPH = "https://gateway.thegraph.com/api/288c326f563ea1c902796752e5b77164/subgraphs/id/EYCKATKGBKLWvSfwvBjzfCBmGwYNdVkduYXVivCsLRFu"
 
+SWAP_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("timestamp", pa.int64()),
+    ("amount0In", pa.float64()),
+    ("amount0Out", pa.float64()),
+    ("amount1In", pa.float64()),
+    ("amount1Out", pa.float64()),
+    ("token0", pa.string()),
+    ("token1", pa.string()),
+])
+_RAW_SWAP_SCHEMA = raw_schema(SWAP_SCHEMA)
 
-def fetch_uniswap_v2_trades(start_timestamp, end_timestamp, batch_size=1000, token_pair=("WETH", "USDT")):
-    """
-    Fetch swap events for WETH/USDT from Uniswap v2 subgraph in [start_timestamp, end_timestamp).
-    Uses simple GraphQL pagination. 
-    Returns a Pandas DataFrame.
-    """
-    
-    # The Graph endpoint might limit how many results per query (1000 for example).
-    # We'll use a 'last_id' approach for pagination.
-    
-    all_swaps = []
-    last_id = ""
-    
-    while True:
-        query = """
-        query($startTime: Int!, $endTime: Int!, $lastID: String!) {
-          swaps(
+_BUCKET_FIELD = """
+          b%(k)d: swaps(
             where: {
               timestamp_gte: $startTime,
               timestamp_lt:  $endTime,
-              id_gt: $lastID
+              id_gt: $last%(k)d,
+              id_lt: $hi%(k)d
             }
             orderBy: id
             orderDirection: asc
-            first: %d
+            first: %(batch_size)d
           ) {
             id
             timestamp
@@ -49,62 +48,37 @@ def fetch_uniswap_v2_trades(start_timestamp, end_timestamp, batch_size=1000, tok
               token0 { symbol }
               token1 { symbol }
             }
-          }
-        }
-        """ % batch_size
-        
-        variables = {
-            "startTime": int(start_timestamp),
-            "endTime": int(end_timestamp),
-            "lastID": last_id
-        }
-        print(f"Fetching from last_id={last_id} ...")
-        response = requests.post(
-        UNISWAP_V2_SUBGRAPH,
-        json={"query": query, "variables": variables}
-        )
+          }"""
 
-        print("Response received.")
-        response_json = response.json()
-        
-        if "data" not in response_json or "swaps" not in response_json["data"]:
-            # If an error or unexpected structure occurs
-            print("Error in response:", response_json)
-            break
-        
-        swaps = response_json["data"]["swaps"]
-        if not swaps:
-            # No more data
-            break
-        
-        all_swaps.extend(swaps)
-        print(f"Got {len(swaps)} new swaps, total so far: {len(all_swaps)}")
 
-        
-        last_id = swaps[-1]["id"]  # update pagination key
-        
-        # Rate limit
-        time.sleep(0.2)
-    
-    df = pd.DataFrame(all_swaps)
+def _to_table(swaps, token_pair):
+    """
+    Flatten one page of Uniswap v2 swaps into an Arrow table and keep only the rows trading `token_pair`.
+    """
+    cols = {
+        "id": [s["id"] for s in swaps],
+        "timestamp": pa.array([int(s["timestamp"]) for s in swaps], type=pa.int64()),
+        "amount0In": [s["amount0In"] for s in swaps],
+        "amount0Out": [s["amount0Out"] for s in swaps],
+        "amount1In": [s["amount1In"] for s in swaps],
+        "amount1Out": [s["amount1Out"] for s in swaps],
+        "token0": [s["pair"]["token0"]["symbol"] for s in swaps],
+        "token1": [s["pair"]["token1"]["symbol"] for s in swaps],
+    }
+    table = pa.Table.from_pydict(cols, schema=_RAW_SWAP_SCHEMA).cast(SWAP_SCHEMA)
+    return filter_token_pair(table, "token0", "token1", token_pair)
 
-    if df.empty:
-      print("Fetched 0 swaps. Exiting fetch_uniswap_v2_trades.")
-      return df
 
-    
-    # Convert timestamp to int
-    df["timestamp"] = df["timestamp"].astype(int)
-    # Filter only WETH/USDT
-    # For v2, we might need to ensure the pair tokens are exactly WETH and USDT
-    def is_weth_usdt(pair_info):
-        t0 = pair_info["token0"]["symbol"]
-        t1 = pair_info["token1"]["symbol"]
-        return (t0 in token_pair) and (t1 in token_pair)
-    
-    df = df[df["pair"].apply(is_weth_usdt)]
-    
-    return df
+async def fetch_uniswap_v2_trades(start_timestamp, end_timestamp, out_parquet, batch_size=1000, token_pair=("WETH", "USDT")):
+    """
+    Fetch swap events for WETH/USDT from Uniswap v2 subgraph in [start_timestamp, end_timestamp).
+    Uses simple GraphQL pagination and streams each filtered page into `out_parquet`.
+    Returns the number of swaps written.
+    """
+    return await fetch_to_parquet(
+        UNISWAP_V2_SUBGRAPH, _BUCKET_FIELD, SWAP_SCHEMA, _to_table,
+        start_timestamp, end_timestamp, out_parquet, batch_size, token_pair
+    )
 
 
 if __name__ == "__main__":
@@ -115,12 +89,10 @@ if __name__ == "__main__":
     start_timestamp = int(start_dt.timestamp())
     end_timestamp   = int(end_dt.timestamp())
     
-    df_v2 = fetch_uniswap_v2_trades(start_timestamp, end_timestamp)
-    print(f"Fetched {len(df_v2)} Uniswap v2 swaps")
-    
     # Ensure data folder
     os.makedirs("data", exist_ok=True)
     
-    out_csv = "data/uniswap_v2_jan2024.csv"
-    df_v2.to_csv(out_csv, index=False)
-    print(f"Saved to {out_csv}")
+    out_parquet = "data/uniswap_v2_jan2024.parquet"
+    n_v2 = asyncio.run(fetch_uniswap_v2_trades(start_timestamp, end_timestamp, out_parquet))
+    print(f"Fetched {n_v2} Uniswap v2 swaps")
+    print(f"Saved to {out_parquet}")
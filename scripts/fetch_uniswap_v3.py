@@ -1,38 +1,40 @@
 #!/usr/bin/env python3
 """
 Fetch Uniswap v3 WETH/USDT trades for Jan 2024 from The Graph subgraph.
-Outputs CSV: data/uniswap_v3_jan2024.csv
+Outputs Parquet: data/uniswap_v3_jan2024.parquet
 """
 
-import requests
-import pandas as pd
-import time
+import asyncio
 import os
 from datetime import datetime
 
+import pyarrow as pa
+
+from _subgraph import fetch_to_parquet, filter_token_pair, raw_schema
+
 UNISWAP_V3_SUBGRAPH = "https://gateway.thegraph.com/api/d9b773b884c7026f7e40ca5a33b91ce9/subgraphs/id/HUZDsRpEVP2AvzDCyzDHtdc64dyDxx8FQjzsmqSg4H3B"
 
-def fetch_uniswap_v3_trades(start_timestamp, end_timestamp, batch_size=1000, token_pair=("WETH", "USDT")):
-    """
-    Fetch swap events for WETH/USDT from Uniswap v3 subgraph in [start_timestamp, end_timestamp).
-    Returns a Pandas DataFrame.
-    """
-    
-    all_swaps = []
-    last_id = ""
-    
-    while True:
-        query = """
-        query($startTime: Int!, $endTime: Int!, $lastID: String!) {
-          swaps(
+SWAP_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("timestamp", pa.int64()),
+    ("amount0", pa.float64()),
+    ("amount1", pa.float64()),
+    ("token0", pa.string()),
+    ("token1", pa.string()),
+])
+_RAW_SWAP_SCHEMA = raw_schema(SWAP_SCHEMA)
+
+_BUCKET_FIELD = """
+          b%(k)d: swaps(
             where: {
               timestamp_gte: $startTime,
               timestamp_lt:  $endTime,
-              id_gt: $lastID
+              id_gt: $last%(k)d,
+              id_lt: $hi%(k)d
             }
             orderBy: id
             orderDirection: asc
-            first: %d
+            first: %(batch_size)d
           ) {
             id
             timestamp
@@ -42,46 +44,34 @@ def fetch_uniswap_v3_trades(start_timestamp, end_timestamp, batch_size=1000, tok
               token0 { symbol }
               token1 { symbol }
             }
-          }
-        }
-        """ % batch_size
-        
-        variables = {
-            "startTime": int(start_timestamp),
-            "endTime": int(end_timestamp),
-            "lastID": last_id
-        }
-        
-        response = requests.post(UNISWAP_V3_SUBGRAPH, json={"query": query, "variables": variables})
-        response_json = response.json()
-        
-        if "data" not in response_json or "swaps" not in response_json["data"]:
-            print("Error in response:", response_json)
-            break
-        
-        swaps = response_json["data"]["swaps"]
-        if not swaps:
-            break
-        
-        all_swaps.extend(swaps)
-        
-        last_id = swaps[-1]["id"]
-        
-        # Rate limit
-        time.sleep(0.2)
-    
-    df = pd.DataFrame(all_swaps)
-    df["timestamp"] = df["timestamp"].astype(int)
-    
-    # Filter to WETH/USDT
-    def is_weth_usdt(pool_info):
-        t0 = pool_info["token0"]["symbol"]
-        t1 = pool_info["token1"]["symbol"]
-        return (t0 in token_pair) and (t1 in token_pair)
-    
-    df = df[df["pool"].apply(is_weth_usdt)]
-    
-    return df
+          }"""
+
+
+def _to_table(swaps, token_pair):
+    """
+    Flatten one page of Uniswap v3 swaps into an Arrow table and keep only the rows trading `token_pair`.
+    """
+    cols = {
+        "id": [s["id"] for s in swaps],
+        "timestamp": pa.array([int(s["timestamp"]) for s in swaps], type=pa.int64()),
+        "amount0": [s["amount0"] for s in swaps],
+        "amount1": [s["amount1"] for s in swaps],
+        "token0": [s["pool"]["token0"]["symbol"] for s in swaps],
+        "token1": [s["pool"]["token1"]["symbol"] for s in swaps],
+    }
+    table = pa.Table.from_pydict(cols, schema=_RAW_SWAP_SCHEMA).cast(SWAP_SCHEMA)
+    return filter_token_pair(table, "token0", "token1", token_pair)
+
+
+async def fetch_uniswap_v3_trades(start_timestamp, end_timestamp, out_parquet, batch_size=1000, token_pair=("WETH", "USDT")):
+    """
+    Fetch swap events for WETH/USDT from Uniswap v3 subgraph in [start_timestamp, end_timestamp).
+    Streams each filtered page into `out_parquet` and returns the number of swaps written.
+    """
+    return await fetch_to_parquet(
+        UNISWAP_V3_SUBGRAPH, _BUCKET_FIELD, SWAP_SCHEMA, _to_table,
+        start_timestamp, end_timestamp, out_parquet, batch_size, token_pair
+    )
 
 
 if __name__ == "__main__":
@@ -92,11 +82,9 @@ if __name__ == "__main__":
     start_timestamp = int(start_dt.timestamp())
     end_timestamp   = int(end_dt.timestamp())
     
-    df_v3 = fetch_uniswap_v3_trades(start_timestamp, end_timestamp)
-    print(f"Fetched {len(df_v3)} Uniswap v3 swaps")
-    
     os.makedirs("data", exist_ok=True)
     
-    out_csv = "data/uniswap_v3_jan2024.csv"
-    df_v3.to_csv(out_csv, index=False)
-    print(f"Saved to {out_csv}")
+    out_parquet = "data/uniswap_v3_jan2024.parquet"
+    n_v3 = asyncio.run(fetch_uniswap_v3_trades(start_timestamp, end_timestamp, out_parquet))
+    print(f"Fetched {n_v3} Uniswap v3 swaps")
+    print(f"Saved to {out_parquet}")
@@ -8,19 +8,16 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import os
 
-def plot_average_costs(v2_csv="data/uniswap_v2_aggregated.csv",
-                       v3_csv="data/uniswap_v3_aggregated.csv",
-                       # cw_csv="data/cowswap_aggregated.csv",
+def plot_average_costs(v2_parquet="data/uniswap_v2_aggregated.parquet",
+                       v3_parquet="data/uniswap_v3_aggregated.parquet",
+                       # cw_parquet="data/cowswap_aggregated.parquet",
                        out_file="results/average_costs.png"):
     # Load aggregated data
-    df_v2 = pd.read_csv(v2_csv)
-    df_v3 = pd.read_csv(v3_csv)
-    # df_cw = pd.read_csv(cw_csv)
+    df_v2 = pd.read_parquet(v2_parquet)
+    df_v3 = pd.read_parquet(v3_parquet)
+    # df_cw = pd.read_parquet(cw_parquet)
     
-    # Convert the 'bucket' category to string for plotting
-    df_v2["bucket_str"] = df_v2["bucket"].astype(str)
-    df_v3["bucket_str"] = df_v3["bucket"].astype(str)
-    # df_cw["bucket_str"] = df_cw["bucket"].astype(str)
+    # 'bucket_str' labels are written by analyze.bucket_by_trade_size, so no conversion is needed here
     
     fig, ax = plt.subplots(figsize=(10, 6))
     